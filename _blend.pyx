@@ -0,0 +1,22 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# distutils: extra_compile_args = -O3 -march=native -fopenmp
+# distutils: extra_link_args = -fopenmp
+
+# Ahead-of-time build of the reduce_banding detail blend, so short runs skip Numba's JIT.
+# Build in place with: cythonize -i _blend.pyx
+
+from cython.parallel import prange
+
+
+def blend(const float[:, :] image, const float[:, :] fine, const float[:, :] large, float boost, float thr, out):
+    cdef float[:, :] o = out
+    cdef Py_ssize_t h = image.shape[0]
+    cdef Py_ssize_t w = image.shape[1]
+    cdef Py_ssize_t i, j
+    cdef float d, m
+    for i in prange(h, nogil=True):
+        for j in range(w):
+            d = image[i, j] - fine[i, j]
+            m = 1.0 if (d if d >= 0 else -d) > thr else 0.0
+            o[i, j] = large[i, j] + m * (fine[i, j] + d * boost - large[i, j])
+    return out
@@ -3,9 +3,20 @@ import cv2
 import OpenEXR
 import Imath
 import argparse
+import os
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numba
+from numba import njit, prange
 from PIL import Image
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.exr')
+
+# Per-thread smoothing buffers, reused across frames of the same shape in directory mode
+_scratch = threading.local()
+
 def read_image(file_path):
     # Check if the file is an EXR
     if file_path.lower().endswith('.exr'):
@@ -24,87 +35,340 @@ def read_image(file_path):
     if len(img.shape) == 3:
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
-    if img.dtype == np.uint8:
-        img = img.astype(np.float32) / 255.0
-    elif img.dtype == np.uint16:
-        img = img.astype(np.float32) / 65535.0
-    else:
-        img = img.astype(np.float32)
+    # 8/16-bit data stays at its native dtype and is only promoted to float32 where it is first filtered
+    if img.dtype not in (np.uint8, np.uint16):
+        img = np.ascontiguousarray(img, dtype=np.float32)
     
     return img
 
 def read_exr(file_path):
-    file = OpenEXR.InputFile(file_path)
-    dw = file.header()['dataWindow']
-    size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
-
-    channelData = file.channel('Y', Imath.PixelType(Imath.PixelType.FLOAT))
-    img = np.frombuffer(channelData, dtype=np.float32)
-    img.shape = (size[1], size[0])
-    return img
+    # OpenEXR >= 3 decodes straight into a numpy array, with no intermediate bytes copy of the channel
+    with OpenEXR.File(file_path) as file:
+        pixels = file.channels()['Y'].pixels
+    return np.ascontiguousarray(pixels, dtype=np.float32)
 
 def normalize_image(image):
-    return (image - np.min(image)) / (np.max(image) - np.min(image))
+    # np.min/np.max are SIMD reductions; the rescale is then one fused pass into a fresh float32 array
+    mn = np.float32(np.min(image))
+    mx = np.float32(np.max(image))
+    if mx == mn:
+        # Flat frame: there is no range to stretch
+        return np.zeros(image.shape, dtype=np.float32)
+    return _normalize(image, mn, np.float32(1.0) / (mx - mn), np.empty(image.shape, dtype=np.float32))
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _normalize(image, mn, inv_range, out):
+    # Specialized per input dtype on first use, so 8/16-bit data is promoted while it is rescaled
+    h, w = image.shape
+    for i in prange(h):
+        for j in range(w):
+            out[i, j] = (np.float32(image[i, j]) - mn) * inv_range
+    return out
 
 def extend_dynamic_range(image, black_point, white_point):
     # Find the current min and max values of the image
-    current_min = np.min(image)
-    current_max = np.max(image)
-    
-    # Calculate the scaling factor
-    scale = (white_point - black_point) / (current_max - current_min)
-    
-    # Apply the scaling and shifting to use the full range
-    image = (image - current_min) * scale + black_point
-    
-    # Ensure the values are clipped to the desired range
-    image = np.clip(image, black_point, white_point)
+    current_min = np.float32(np.min(image))
+    current_max = np.float32(np.max(image))
     
-    # Normalize to [0, 1] range
-    image = (image - black_point) / (white_point - black_point)
-    
-    return image
+    # Scaling to [black_point, white_point], clipping and normalizing back to [0, 1]
+    # reduces to clipping to [current_min, current_max] and rescaling by their range
+    inv_range = np.float32(1.0 / (current_max - current_min))
+    return _extend_range(image, current_min, current_max, inv_range)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _extend_range(image, black_point, white_point, inv_range):
+    # Clip and rescale in one read/write per pixel; specialized per input dtype on first use
+    h, w = image.shape
+    out = np.empty((h, w), dtype=np.float32)
+    for i in prange(h):
+        for j in range(w):
+            v = np.float32(image[i, j])
+            if v < black_point:
+                v = black_point
+            elif v > white_point:
+                v = white_point
+            out[i, j] = (v - black_point) * inv_range
+    return out
 
-def process_depth_image(input_path, output_path, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma, black_point, white_point):
+def process_depth_image(input_path, output_path, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma, black_point, white_point, device='cpu'):
     try:
         depth_map = read_image(input_path)
     except ValueError as e:
         print(f"Error: {e}")
         sys.exit(1)
     
+    try:
+        final = smooth_depth_map(depth_map, large_scale, fine_scale, boost, detail_threshold,
+                                 spatial_sigma, range_sigma, black_point, white_point, device)
+    except (RuntimeError, cv2.error) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    
+    try:
+        save_exr(output_path, final)
+    except Exception as e:
+        print(f"Error saving EXR file: {e}")
+        sys.exit(1)
+
+def smooth_depth_map(depth_map, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma, black_point, white_point, device='cpu'):
     # Extend dynamic range if black_point and white_point are provided
     if black_point is not None and white_point is not None:
         depth_map = extend_dynamic_range(depth_map, black_point, white_point)
     else:
         depth_map = normalize_image(depth_map)
     
+    if device == 'cuda':
+        return smooth_cuda(depth_map, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma)
+    
     # First pass: reduce banding
-    smoothed = reduce_banding(depth_map, large_scale, fine_scale, boost, detail_threshold)
+    smoothed = reduce_banding(depth_map, large_scale, fine_scale, boost, detail_threshold,
+                              out=_scratch_buffers(depth_map.shape)[2])
     
     # Second pass: edge-preserving smoothing
-    final = edge_preserving_smooth(smoothed, spatial_sigma, range_sigma)
+    return edge_preserving_smooth(smoothed, spatial_sigma, range_sigma)
+
+def plan_outputs(input_dir, output_dir):
+    # Pair every image in input_dir with its output path, refusing anything that would overwrite another file
+    if os.path.realpath(input_dir) == os.path.realpath(output_dir):
+        raise ValueError("The output directory must differ from the input directory")
+    jobs = []
+    sources = {}
+    for name in sorted(os.listdir(input_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        output_name = os.path.splitext(name)[0] + '.exr'
+        if output_name.lower() in sources:
+            raise ValueError(f"{sources[output_name.lower()]} and {name} would both be saved as {output_name}")
+        sources[output_name.lower()] = name
+        jobs.append((name, os.path.join(output_dir, output_name)))
+    return jobs
+
+def process_directory(input_dir, output_dir, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma, black_point, white_point, device='cpu', workers=1):
+    try:
+        jobs = plan_outputs(input_dir, output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
     
+    # Warm up the per-frame path once for every dtype read_image returns, so _extend_range is
+    # compiled here rather than mid-batch; this also initialises Numba's threading layer for the check below
+    ramp = np.arange(64).reshape(8, 8)
     try:
+        for warmup in (ramp.astype(np.uint8), ramp.astype(np.uint16), ramp.astype(np.float32) / 63.0):
+            smooth_depth_map(warmup, large_scale, fine_scale, boost, detail_threshold,
+                             spatial_sigma, range_sigma, black_point, white_point, device)
+    except (RuntimeError, cv2.error) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if numba.threading_layer() == 'workqueue':
+        # The workqueue layer cannot run parallel kernels from several threads at once
+        workers = 1
+    
+    def process(input_path, output_path):
+        depth_map = read_image(input_path)
+        final = smooth_depth_map(depth_map, large_scale, fine_scale, boost, detail_threshold,
+                                 spatial_sigma, range_sigma, black_point, white_point, device)
         save_exr(output_path, final)
-    except Exception as e:
-        print(f"Error saving EXR file: {e}")
+    
+    # Results are reported from this thread only, so log lines never interleave
+    failed = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process, os.path.join(input_dir, name), output_path): (name, output_path)
+                   for name, output_path in jobs}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            name, output_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing {name}: {e}")
+                if not failed:
+                    # Stop on the first failure: drop every file that has not started yet
+                    failed = True
+                    for pending in futures:
+                        pending.cancel()
+            else:
+                print(f"Processed {name} -> {output_path}")
+    
+    if failed:
         sys.exit(1)
+    
+    return len(jobs)
+
+def process_sequence(input_dir, output_dir, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma, black_point, white_point, device='cpu'):
+    # Three-stage pipeline: frame N+1 is read while frame N is smoothed and frame N-1 is written.
+    # The single worker thread reuses its per-thread scratch buffers since frames share a shape.
+    try:
+        jobs = plan_outputs(input_dir, output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
+    read_queue = queue.Queue(maxsize=4)
+    write_queue = queue.Queue(maxsize=4)
+    errors = []
+    
+    def reader():
+        # Only the reader stops after a failure; frames already read are still smoothed and written
+        for name, output_path in jobs:
+            if errors:
+                break
+            try:
+                read_queue.put((name, output_path, read_image(os.path.join(input_dir, name))))
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+        read_queue.put(None)
+    
+    def worker():
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            name, output_path, depth_map = item
+            try:
+                write_queue.put((name, output_path, smooth_depth_map(depth_map, large_scale, fine_scale, boost, detail_threshold,
+                                                                     spatial_sigma, range_sigma, black_point, white_point, device)))
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+        write_queue.put(None)
+    
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            name, output_path, final = item
+            try:
+                save_exr(output_path, final)
+                print(f"Processed {name} -> {output_path}")
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+    
+    threads = [threading.Thread(target=stage) for stage in (reader, worker, writer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        for error in errors:
+            print(f"Error processing {error}")
+        sys.exit(1)
+    
+    return len(jobs)
+
+def reduce_banding(image, large_scale=15, fine_scale=3, boost=1.5, detail_threshold=0.02, out=None):
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    if not image.flags.writeable:
+        # The Numba kernels' signatures take writable arrays only, e.g. not np.frombuffer views
+        image = image.copy()
+    # Guided filter is O(N) regardless of radius, unlike a d=large_scale bilateral.
+    # The large-scale pass is low-frequency, so run it at half resolution with half the radius and upsample.
+    small = cv2.resize(image, _half_size(image.shape), interpolation=cv2.INTER_AREA)
+    large_small = cv2.ximgproc.guidedFilter(guide=small, src=small, radius=max(1, large_scale // 4), eps=0.01**2)
+    large_buf, fine_buf, _ = _scratch_buffers(image.shape)
+    large_smooth = cv2.resize(large_small, (image.shape[1], image.shape[0]), dst=large_buf, interpolation=cv2.INTER_LINEAR)
+    fine_smooth = cv2.bilateralFilter(image, d=fine_scale, sigmaColor=0.1, sigmaSpace=fine_scale, dst=fine_buf)
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    return _blend(image, fine_smooth, large_smooth, np.float32(boost), np.float32(detail_threshold), out)
+
+def _half_size(shape):
+    # cv2 dsize (width, height) at half resolution, never rounding a 1-pixel dimension down to 0
+    h, w = shape
+    return (max(1, w // 2), max(1, h // 2))
+
+try:
+    # Ahead-of-time compiled blend from _blend.pyx, when built; avoids JIT warmup on short runs
+    from _blend import blend as _blend
+except ImportError:
+    @njit('f4[:,:](f4[:,:], f4[:,:], f4[:,:], f4, f4, f4[:,:])', parallel=True, fastmath=True, cache=True)
+    def _blend(image, fine, large, boost, thr, out):
+        # Detail boost and threshold select in one pass; the select is a 0/1 mask multiply so it
+        # vectorizes to a compare-and-blend instead of a data-dependent branch
+        h, w = image.shape
+        for i in prange(h):
+            for j in range(w):
+                d = image[i, j] - fine[i, j]
+                m = np.float32(1.0) if abs(d) > thr else np.float32(0.0)
+                out[i, j] = large[i, j] + m * (fine[i, j] + d * boost - large[i, j])
+        return out
 
+def _scratch_buffers(shape):
+    # Large-scale, fine-scale and blend outputs
+    bufs = getattr(_scratch, 'bufs', None)
+    if bufs is None or bufs[0].shape != shape:
+        bufs = tuple(np.empty(shape, dtype=np.float32) for _ in range(3))
+        _scratch.bufs = bufs
+    return bufs
 
-def reduce_banding(image, large_scale=15, fine_scale=3, boost=1.5, detail_threshold=0.02):
-    large_smooth = cv2.bilateralFilter(image, d=large_scale, sigmaColor=0.1, sigmaSpace=large_scale)
-    fine_smooth = cv2.bilateralFilter(image, d=fine_scale, sigmaColor=0.1, sigmaSpace=fine_scale)
-    detail = image - fine_smooth
-    boosted = fine_smooth + detail * boost
-    result = np.where(np.abs(detail) > detail_threshold, boosted, large_smooth)
-    return normalize_image(result)
+def _bilateral_radius(d, sigma_space):
+    # cv::bilateralFilter's rule: half the diameter, or 1.5 sigma when d <= 0, and at least 1
+    radius = d // 2 if d > 0 else int(round(sigma_space * 1.5))
+    return max(radius, 1)
 
 def edge_preserving_smooth(image, spatial_sigma, range_sigma):
     return cv2.bilateralFilter(image, d=-1, sigmaColor=range_sigma, sigmaSpace=spatial_sigma)
 
+def smooth_cuda(image, large_scale, fine_scale, boost, detail_threshold, spatial_sigma, range_sigma):
+    # Same algorithm as the CPU path: upload once, filter with cv2.cuda and CuPy on the same memory, download once
+    try:
+        import cupy as cp
+        from cupyx.scipy import ndimage as cp_ndimage
+    except ImportError:
+        raise RuntimeError("CuPy is required for --device cuda")
+    
+    h, w = image.shape
+    gpu_img = cv2.cuda_GpuMat()
+    gpu_img.upload(np.ascontiguousarray(image, dtype=np.float32))
+    
+    # Large scale: guided filter at half resolution, as in reduce_banding
+    gpu_small = cv2.cuda.resize(gpu_img, _half_size(image.shape), interpolation=cv2.INTER_AREA)
+    gpu_large_small = cv2.cuda_GpuMat(gpu_small.size(), cv2.CV_32FC1)
+    _gpumat_as_cupy(gpu_large_small, cp)[...] = _guided_filter_cupy(_gpumat_as_cupy(gpu_small, cp), max(1, large_scale // 4),
+                                                                    0.01**2, cp_ndimage)
+    cp.cuda.get_current_stream().synchronize()
+    gpu_large = cv2.cuda.resize(gpu_large_small, (w, h), interpolation=cv2.INTER_LINEAR)
+    
+    # cv2.cuda.bilateralFilter takes a kernel size, so pass the diameter of the radius the CPU filters use
+    fine_sigma = fine_scale if fine_scale > 0 else 1
+    gpu_fine = cv2.cuda.bilateralFilter(gpu_img, 2 * _bilateral_radius(fine_scale, fine_sigma) + 1, 0.1, fine_sigma)
+    
+    img = _gpumat_as_cupy(gpu_img, cp)
+    large = _gpumat_as_cupy(gpu_large, cp)
+    fine = _gpumat_as_cupy(gpu_fine, cp)
+    detail = img - fine
+    
+    # Write the blend into a GpuMat for the edge-preserving pass
+    gpu_smoothed = cv2.cuda_GpuMat(gpu_img.size(), cv2.CV_32FC1)
+    _gpumat_as_cupy(gpu_smoothed, cp)[...] = cp.where(cp.abs(detail) > detail_threshold, fine + detail * boost, large)
+    cp.cuda.get_current_stream().synchronize()
+    
+    gpu_final = cv2.cuda.bilateralFilter(gpu_smoothed, 2 * _bilateral_radius(-1, spatial_sigma) + 1, range_sigma, spatial_sigma)
+    return gpu_final.download()
+
+def _guided_filter_cupy(image, radius, eps, cp_ndimage):
+    # Self-guided filter from box means, with the symmetric border cv2.ximgproc.guidedFilter uses
+    def box(x):
+        return cp_ndimage.uniform_filter(x, size=2 * radius + 1, mode='reflect')
+    mean = box(image)
+    var = box(image * image) - mean * mean
+    a = var / (var + eps)
+    b = mean - a * mean
+    return box(a) * image + box(b)
+
+def _gpumat_as_cupy(mat, cp):
+    # Zero-copy CuPy view of a single-channel float32 GpuMat, honouring its row pitch
+    cols, rows = mat.size()
+    mem = cp.cuda.UnownedMemory(mat.cudaPtr(), mat.step * rows, mat)
+    return cp.ndarray((rows, cols), dtype=cp.float32, memptr=cp.cuda.MemoryPointer(mem, 0), strides=(mat.step, 4))
+
 def save_exr(file_path, image):
-    image_float32 = image.astype(np.float32)
-    image_flat = image_float32.tobytes()
+    # No copy when the image is already contiguous float32; writePixels accepts the buffer directly
+    image_float32 = np.ascontiguousarray(image, dtype=np.float32)
+    image_flat = image_float32.data
 
     header = OpenEXR.Header(image.shape[1], image.shape[0])
     header['channels'] = dict(Y=Imath.Channel(Imath.PixelType(Imath.PixelType.FLOAT)))
@@ -127,11 +391,31 @@ def main():
                         help="Black point for dynamic range extension. Range: [0.0, 1.0]. Default: None (no extension)")
     parser.add_argument("--white_point", type=float, default=None, 
                         help="White point for dynamic range extension. Range: [0.0, 1.0]. Must be greater than black point. Default: None (no extension)")
+    parser.add_argument("--input_dir", default=None,
+                        help="Process every image in this directory instead of a single input file. Requires --output_dir")
+    parser.add_argument("--output_dir", default=None, help="Directory for the EXR files written in directory mode")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Number of images processed concurrently in directory mode")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="In directory mode, overlap reading, smoothing and writing of consecutive frames instead of processing whole frames on --workers threads")
+    parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu",
+                        help="Run the smoothing passes on the CPU or on a CUDA GPU. cuda is experimental and not yet tested on GPU hardware; it requires OpenCV built with CUDA and CuPy. Default: cpu")
     
     args = parser.parse_args()
     
-    print(f"Processing depth image: {args.input_file}")
-    print(f"Output will be saved as: {args.output_file}")
+    if args.pipeline and args.input_dir is None:
+        print("Error: --pipeline only applies to directory mode; specify --input_dir and --output_dir.")
+        sys.exit(1)
+    
+    if args.input_dir is not None:
+        if args.output_dir is None:
+            print("Error: --output_dir must be specified together with --input_dir.")
+            sys.exit(1)
+        print(f"Processing depth images in: {args.input_dir}")
+        print(f"Output will be saved in: {args.output_dir}")
+    else:
+        print(f"Processing depth image: {args.input_file}")
+        print(f"Output will be saved as: {args.output_file}")
     
     if args.black_point is not None and args.white_point is not None:
         if args.black_point < 0.0 or args.black_point >= 1.0 or args.white_point <= 0.0 or args.white_point > 1.0 or args.black_point >= args.white_point:
@@ -142,10 +426,28 @@ def main():
         print("Error: Both black_point and white_point must be specified for dynamic range extension.")
         sys.exit(1)
     
+    if args.device == "cuda" and (not hasattr(cv2, "cuda") or cv2.cuda.getCudaEnabledDeviceCount() == 0):
+        print("Error: --device cuda requires OpenCV built with CUDA support and a CUDA-capable GPU.")
+        sys.exit(1)
+    
+    if args.input_dir is not None:
+        if args.pipeline:
+            count = process_sequence(args.input_dir, args.output_dir,
+                                     args.large_scale, args.fine_scale, args.boost, args.detail_threshold,
+                                     args.spatial_sigma, args.range_sigma,
+                                     args.black_point, args.white_point, args.device)
+        else:
+            count = process_directory(args.input_dir, args.output_dir,
+                                      args.large_scale, args.fine_scale, args.boost, args.detail_threshold,
+                                      args.spatial_sigma, args.range_sigma,
+                                      args.black_point, args.white_point, args.device, args.workers)
+        print(f"Processed {count} depth images into {args.output_dir}")
+        return
+    
     process_depth_image(args.input_file, args.output_file, 
                         args.large_scale, args.fine_scale, args.boost, args.detail_threshold,
                         args.spatial_sigma, args.range_sigma,
-                        args.black_point, args.white_point)
+                        args.black_point, args.white_point, args.device)
     
     print(f"Processed depth image saved as {args.output_file}")
 